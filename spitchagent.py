@@ -1,12 +1,20 @@
 import os
 import json
 import sys
+import time
 import asyncio
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
+
+import orjson
 from dotenv import load_dotenv
 
+# Only the main process loads .env (job processes inherit its environment). download-files needs
+# it too: it exports/prewarms whatever EMBEDDING_* selects. Loaded before vector_search reads them.
+if __name__ == "__main__":
+    load_dotenv()
+
 from livekit import agents
-from livekit.agents import JobContext, WorkerOptions, cli, Agent, AutoSubscribe, AgentSession, RoomInputOptions
+from livekit.agents import JobContext, JobProcess, WorkerOptions, cli, Agent, AutoSubscribe, AgentSession, RoomInputOptions
 from livekit.plugins import (
     spitch,
     assemblyai,
@@ -15,26 +23,90 @@ from livekit.plugins import (
     silero,
 )
 
-from vector_search import RAGService
-from sentence_transformers import SentenceTransformer
+from vector_search import (
+    RAGService,
+    LocalIndex,
+    get_embedder,
+    export_quantized_embedder,
+    prefetch_embedder_weights,
+    EMBEDDING_BACKEND,
+    TORCH_COMPILE,
+)
 
-load_dotenv()
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+# How long a tenant's on-disk index snapshot is reused across jobs;
+# documents uploaded meanwhile show up once the snapshot expires
+TENANT_CACHE_TTL = 3600.0
+
+# Static Orthodox Gadgets cold call script, serialized once for every agent's instructions
+_COLD_CALL_SCRIPT = {
+    "script_title": "Orthodox Gadgets Cold Call Script (Entry-Level Techies)",
+    "sections": [
+        {
+            "title": "Opening",
+            "content": "Good day, this is [Your Name] with Orthodox Gadgets. We work with people just getting started in tech—helping them find reliable laptops without breaking the bank. Did I catch you at an okay time?"
+        },
+        {
+            "title": "Build Rapport",
+            "content": "Awesome. Just so I don’t waste your time—are you currently studying, starting a new tech role, or just getting into tech as a hobby?"
+        },
+        {
+            "title": "Discovery Questions (BANT)",
+            "Need": [
+                "What are you mainly planning to use a laptop for—coding, design, studying, or more general use?",
+                "What’s been your biggest frustration with the device you’re using now, if any?"
+            ],
+            "Budget": [
+                "Do you already have a budget range in mind for a new laptop, or are you open to options?"
+            ],
+            "Timeline": [
+                "Are you looking to get a new laptop right away, or sometime in the next few months?"
+            ],
+            "Authority": [
+                "Will this be a personal purchase, or will someone else (like family or employer) be helping with the decision?"
+            ]
+        },
+        {
+            "title": "Qualification Recap",
+            "content": "Got it—so you’re looking for [summary]. That’s definitely something we can help with."
+        },
+        {
+            "title": "Handoff to Closer",
+            "content": "The best next step would be a quick call with one of our laptop specialists. They can recommend the right model for your needs and budget, and even walk you through some exclusive offers. Does [suggest time] work for you?"
+        },
+        {
+            "title": "Close the Call",
+            "content": "Perfect, I’ll send you a quick confirmation email/text for [date/time]. Thanks for your time today, [Name]. Excited to help you get set up with the right laptop as you kick off your tech journey!"
+        }
+    ],
+    "agent_notes": [
+        "Keep it warm and encouraging—many are students or first-jobbers.",
+        "Focus on listening to their needs (coding vs. design vs. general use).",
+        "Don’t sell specs—just qualify and hand off.",
+        "Capture BANT answers in CRM for the closer."
+    ]
+}
+_COLD_CALL_SCRIPT_JSON = json.dumps(_COLD_CALL_SCRIPT, indent=2)
 
 class SalesAgent(Agent):
-    def __init__(self, user_context: Dict[str, Any], vector_service: RAGService):
+    def __init__(
+        self,
+        user_context: Dict[str, Any],
+        vector_service: RAGService,
+        index: Optional[LocalIndex],
+        business_context: str,
+    ):
         self.user_context = user_context
         self.user_id = user_context["userId"]  # Fail if missing
         self.user_name = user_context.get("name", "there")
         self.agent_name = user_context.get("agentName")
         self.company_name = user_context.get("companyName")
-        self.embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-        self.vector_service = RAGService(SUPABASE_URL, SUPABASE_KEY, self.embedder)
-        # self.vector_service = vector_service
+        self.vector_service = vector_service
+
+        # Local index over this user's chunks (from the service's per-tenant disk cache) so turns skip the Supabase RPC
+        self.index = index
         
-        # Load all business context once at initialization
-        self.business_context = self._load_business_context()
+        # All business context, derived by the service from the tenant's index
+        self.business_context = business_context
         print("loaded business content")
 
         self.cold_call_script = self._load_cold_call_script()
@@ -65,74 +137,14 @@ Use this script as your guide to structure calls with prospects.
         
         super().__init__(instructions=base_instructions)
 
-    def _load_business_context(self) -> str:
-        """Load all business context once during initialization"""
-        # Get comprehensive business context using broad search terms
-        context = self.vector_service.get_context(
-            "Company overview", 
-            self.user_id,
-            max_chunks=15  # Get more chunks for complete business picture
-        )
-        
-        if not context:
-            raise ValueError(f"No business context found for user {self.user_id}")
-            
-        return context
-    
     def _load_cold_call_script(self) -> str:
         """Static Orthodox Gadgets cold call script"""
-        return json.dumps({
-            "script_title": "Orthodox Gadgets Cold Call Script (Entry-Level Techies)",
-            "sections": [
-                {
-                    "title": "Opening",
-                    "content": "Good day, this is [Your Name] with Orthodox Gadgets. We work with people just getting started in tech—helping them find reliable laptops without breaking the bank. Did I catch you at an okay time?"
-                },
-                {
-                    "title": "Build Rapport",
-                    "content": "Awesome. Just so I don’t waste your time—are you currently studying, starting a new tech role, or just getting into tech as a hobby?"
-                },
-                {
-                    "title": "Discovery Questions (BANT)",
-                    "Need": [
-                        "What are you mainly planning to use a laptop for—coding, design, studying, or more general use?",
-                        "What’s been your biggest frustration with the device you’re using now, if any?"
-                    ],
-                    "Budget": [
-                        "Do you already have a budget range in mind for a new laptop, or are you open to options?"
-                    ],
-                    "Timeline": [
-                        "Are you looking to get a new laptop right away, or sometime in the next few months?"
-                    ],
-                    "Authority": [
-                        "Will this be a personal purchase, or will someone else (like family or employer) be helping with the decision?"
-                    ]
-                },
-                {
-                    "title": "Qualification Recap",
-                    "content": "Got it—so you’re looking for [summary]. That’s definitely something we can help with."
-                },
-                {
-                    "title": "Handoff to Closer",
-                    "content": "The best next step would be a quick call with one of our laptop specialists. They can recommend the right model for your needs and budget, and even walk you through some exclusive offers. Does [suggest time] work for you?"
-                },
-                {
-                    "title": "Close the Call",
-                    "content": "Perfect, I’ll send you a quick confirmation email/text for [date/time]. Thanks for your time today, [Name]. Excited to help you get set up with the right laptop as you kick off your tech journey!"
-                }
-            ],
-            "agent_notes": [
-                "Keep it warm and encouraging—many are students or first-jobbers.",
-                "Focus on listening to their needs (coding vs. design vs. general use).",
-                "Don’t sell specs—just qualify and hand off.",
-                "Capture BANT answers in CRM for the closer."
-            ]
-        }, indent=2)
+        return _COLD_CALL_SCRIPT_JSON
 
-    def get_context_instructions(self, query: str) -> str:
-        """Get instructions for responding to user query"""
-        # Get specific context relevant to their query
-        specific_context = self.vector_service.get_context(query, self.user_id, max_chunks=5)
+    async def get_context_instructions(self, query: str) -> str:
+        """Get per-turn instructions; business context and script are already in the system instructions"""
+        # Get specific context relevant to their query (embedding + search off the event loop)
+        specific_context = await self.vector_service.aget_context(query, self.user_id, 5, self.index)
         
         if specific_context:
             return f"""The prospect just said: "{query}"
@@ -140,29 +152,43 @@ Use this script as your guide to structure calls with prospects.
 MOST RELEVANT INFORMATION FOR THIS RESPONSE:
 {specific_context}
 
-GENERAL BUSINESS CONTEXT (if needed):
-{self.business_context}
-
 Respond naturally to what they said using the most relevant information first. Work toward scheduling or closing."""
         else:
-            # Fall back to general business context
+            # Fall back to the business knowledge already in the agent's system instructions
             return f"""The prospect just said: "{query}"
 
-BUSINESS CONTEXT:
-{self.business_context}
-
 Respond naturally to what they said using your business knowledge. Work toward scheduling or closing."""
 
 
 class SalesAgentService:
     def __init__(self, supabase_url: str, supabase_key: str):
+        # One Supabase client (and HTTPX pool) and the shared embedder for every session in this worker
         self.vector_service = RAGService(supabase_url, supabase_key)
 
+    def _load_tenant(self, user_id: str) -> Tuple[Optional[LocalIndex], str]:
+        """Build the tenant's local index and business context (blocking; run in a thread)"""
+        # Reuses the tenant's on-disk index snapshot; only a stale or missing one downloads every chunk
+        index = self.vector_service.load_index(user_id, max_age=TENANT_CACHE_TTL)
+
+        # Get comprehensive business context using broad search terms
+        context = self.vector_service.get_context(
+            "Company overview",
+            user_id,
+            max_chunks=15,  # Get more chunks for complete business picture
+            index=index,
+        )
+
+        if not context:
+            raise ValueError(f"No business context found for user {user_id}")
+
+        return index, context
+
     async def start_session(self, ctx: JobContext, user_context: Dict[str, Any]):
         """Start agent session - strict mode, no fallbacks"""
         
-        # Create sales agent (this will load all business context)
-        sales_agent = SalesAgent(user_context, self.vector_service)
+        # Create sales agent with the tenant's index and business context, loaded off the event loop
+        index, business_context = await asyncio.to_thread(self._load_tenant, user_context["userId"])
+        sales_agent = SalesAgent(user_context, self.vector_service, index=index, business_context=business_context)
         # Create session
         session = AgentSession(
             turn_detection="stt",
@@ -178,7 +204,7 @@ class SalesAgentService:
             async def process_speech():
                 if event.alternatives:
                     message = event.alternatives[0].text
-                    instructions = sales_agent.get_context_instructions(message)
+                    instructions = await sales_agent.get_context_instructions(message)
                     await session.generate_reply(instructions=instructions)
             
             asyncio.create_task(process_speech())
@@ -210,10 +236,9 @@ class SalesAgentService:
     async def _send_opening(self, sales_agent: SalesAgent, session: AgentSession):
         """Send opening pitch using cold call script"""
     
-        # Extract script opening (we stored it as JSON string in SalesAgent)
-        cold_call = json.loads(sales_agent.cold_call_script)
+        # Extract script opening
         opening_section = next(
-            (s for s in cold_call["sections"] if s["title"] == "Opening"), 
+            (s for s in _COLD_CALL_SCRIPT["sections"] if s["title"] == "Opening"), 
             None
         )
 
@@ -240,6 +265,16 @@ class SalesAgentService:
 # Global service
 agent_service = None
 
+# LiveKit's default initialize_process_timeout (10 s) is too short for prewarm: importing torch,
+# loading the embedder and its warmup encode can take longer on a cold container. With
+# EMBEDDING_TORCH_COMPILE=1 that warmup also compiles the model, which takes minutes on a cold inductor cache
+PREWARM_TIMEOUT = 600.0 if TORCH_COMPILE else 60.0
+
+
+def prewarm(proc: JobProcess):
+    """Load the shared embedder (and its warmup encode) before the process accepts a job"""
+    get_embedder()
+
 
 async def entrypoint(ctx: JobContext):
     """Main entrypoint - strict mode"""
@@ -258,13 +293,10 @@ async def entrypoint(ctx: JobContext):
         agent_service = SalesAgentService(SUPABASE_URL, SUPABASE_KEY)
     
     # Parse user context
-    user_context = {}
-    if ctx.job.metadata:
-        user_context.update(json.loads(ctx.job.metadata))
-        print(user_context)
-    if ctx.room.metadata:
-        print(user_context)
-        user_context.update(json.loads(ctx.room.metadata))
+    job_meta = orjson.loads(ctx.job.metadata) if ctx.job.metadata else {}
+    room_meta = orjson.loads(ctx.room.metadata) if ctx.room.metadata else {}
+    user_context = {**job_meta, **room_meta}
+    print(user_context)
     
     if not user_context.get("userId"):
         raise ValueError("userId required in metadata")
@@ -279,7 +311,15 @@ if __name__ == "__main__":
     # Check if this is the "download-files" build step
     if len(sys.argv) > 1 and sys.argv[1] == "download-files":
         print("Running in download-files mode, skipping SUPABASE env validation...")
-        # call any model/file prefetch logic here if you need
+        # Bake the INT8 ONNX embedder into the image so workers never export at runtime
+        if EMBEDDING_BACKEND != "model2vec":
+            export_quantized_embedder()
+            # A GPU-less build host only loads the ONNX export below; GPU workers and a missing
+            # export fall back to the PyTorch weights, so fetch those too
+            prefetch_embedder_weights()
+        # Load it once to populate the HF tokenizer cache and check the export is usable
+        get_embedder()
+        silero.VAD.load()
         sys.exit(0)
 
     # Normal agent startup → enforce required environment vars
@@ -289,4 +329,10 @@ if __name__ == "__main__":
         raise ValueError(f"Missing environment variables: {missing}")
 
     # Launch the agent worker
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
\ No newline at end of file
+    cli.run_app(
+        WorkerOptions(
+            entrypoint_fnc=entrypoint,
+            prewarm_fnc=prewarm,
+            initialize_process_timeout=PREWARM_TIMEOUT,
+        )
+    )
\ No newline at end of file
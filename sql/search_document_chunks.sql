@@ -0,0 +1,61 @@
+-- Embeddings are L2-normalized at encode time (RAGService normalize_embeddings=True),
+-- so cosine similarity equals the inner product and the search can use pgvector's
+-- cheaper <#> (negative inner product) operator instead of <=> (cosine distance).
+
+-- One-off: normalize vectors stored before ingestion started normalizing them
+update document_chunks set embedding = l2_normalize(embedding);
+
+-- <#> can only use an index built with vector_ip_ops: replace any cosine ANN index,
+-- otherwise the planner falls back to a sequential scan
+do $$
+declare
+    idx record;
+begin
+    for idx in
+        select schemaname, indexname from pg_indexes
+        where tablename = 'document_chunks' and indexdef like '%vector_cosine_ops%'
+    loop
+        execute format('drop index if exists %I.%I', idx.schemaname, idx.indexname);
+    end loop;
+end $$;
+
+create index if not exists document_chunks_embedding_ip_idx
+    on document_chunks using hnsw (embedding vector_ip_ops);
+
+-- Drop every existing overload whatever its parameter types, so the new definition
+-- cannot sit next to an old one and make PostgREST's RPC resolution ambiguous
+do $$
+declare
+    fn regprocedure;
+begin
+    for fn in
+        select p.oid::regprocedure from pg_proc p
+        where p.proname = 'search_document_chunks'
+    loop
+        execute format('drop function %s', fn);
+    end loop;
+end $$;
+
+create function search_document_chunks(
+    query_embedding vector,
+    match_count int,
+    user_id_param uuid
+)
+returns table (
+    document_id uuid,
+    chunk_index int,
+    chunk_text text,
+    similarity float
+)
+language sql stable
+as $$
+    select
+        dc.document_id,
+        dc.chunk_index,
+        dc.chunk_text,
+        -(dc.embedding <#> query_embedding) as similarity
+    from document_chunks dc
+    where dc.user_id = user_id_param
+    order by dc.embedding <#> query_embedding
+    limit match_count;
+$$;
@@ -1,18 +1,259 @@
-from typing import List, Dict, Any
+import os
+import json
+import time
+import hashlib
+import asyncio
+import functools
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+import faiss
+import numpy as np
+import onnxruntime as ort
+import torch
 from supabase import create_client, Client
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+from sentence_transformers.models import StaticEmbedding
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# "model2vec" swaps MiniLM for a distilled static model (no transformer layers, ~100x faster on CPU).
+# It is a different 256-dim vector space, so stored chunks must be re-embedded with it.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "minilm")
+STATIC_EMBEDDING_MODEL = "minishlab/potion-base-8M"
+
+# INT8 ONNX export of EMBEDDING_MODEL, produced by `download-files`
+ONNX_MODEL_DIR = os.getenv(
+    "EMBEDDING_ONNX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "all-MiniLM-L6-v2-onnx"),
+)
+ONNX_QUANTIZED_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+# Per-tenant LocalIndex snapshots; LiveKit runs each job in a fresh process, so memory can't carry them
+INDEX_CACHE_DIR = os.getenv(
+    "INDEX_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "indexes"),
+)
+
+# Token limits: spoken queries are short, 500-char document chunks fit in ~128 tokens
+QUERY_MAX_SEQ_LENGTH = 64
+DOCUMENT_MAX_SEQ_LENGTH = 128
+
+USE_CUDA = torch.cuda.is_available()
+# Opt-in: torch.compile the PyTorch embedder. The load-time warmup compiles in every job process's
+# prewarm, so the worker's initialize_process_timeout must cover it (see PREWARM_TIMEOUT). Inductor
+# kernels are cached under models/ so download-files or the first job can pay codegen for later ones;
+# Dynamo tracing still runs per process.
+TORCH_COMPILE = os.getenv("EMBEDDING_TORCH_COMPILE") == "1"
+if TORCH_COMPILE:
+    os.environ.setdefault(
+        "TORCHINDUCTOR_CACHE_DIR",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "torchinductor"),
+    )
+# Ingestion batch size; a GPU stays saturated with much larger batches
+DOCUMENT_BATCH_SIZE = 256 if USE_CUDA else 64
+
+# Shared across every RAGService / SalesAgent in the worker process
+_EMBEDDER: Optional[SentenceTransformer] = None
+_EMBEDDER_LOCK = threading.Lock()
+# max_seq_length lives on the shared model, so set-and-encode must not interleave
+_ENCODE_LOCK = threading.Lock()
+
+
+def get_embedder() -> SentenceTransformer:
+    """Return the process-wide embedding model, loading it on first use"""
+    global _EMBEDDER
+    if _EMBEDDER is None:
+        with _EMBEDDER_LOCK:
+            if _EMBEDDER is None:
+                embedder = _load_embedder()
+                # Pay graph compilation / session setup now rather than on the first user turn,
+                # through the exact query path so torch.compile guards match real calls
+                _encode_with(embedder, "warmup", QUERY_MAX_SEQ_LENGTH)
+                _EMBEDDER = embedder
+    return _EMBEDDER
+
+
+def _encode_with(model: SentenceTransformer, texts, max_seq_length: int, **kwargs) -> np.ndarray:
+    """Encode with the given token limit, returning normalized numpy embeddings"""
+    with _ENCODE_LOCK, torch.inference_mode():
+        model.max_seq_length = max_seq_length
+        return model.encode(
+            texts,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+            **kwargs,
+        )
+
+
+def _load_embedder() -> SentenceTransformer:
+    """Static model if configured, else the quantized ONNX export, else the FP32 PyTorch model"""
+    if EMBEDDING_BACKEND == "model2vec":
+        return SentenceTransformer(modules=[StaticEmbedding.from_model2vec(STATIC_EMBEDDING_MODEL)])
+
+    # The INT8 export is CPU-only; a GPU runs the PyTorch model much faster
+    if not USE_CUDA and os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_QUANTIZED_FILE)):
+        return SentenceTransformer(
+            ONNX_MODEL_DIR,
+            backend="onnx",
+            model_kwargs={"file_name": ONNX_QUANTIZED_FILE, "session_options": _onnx_session_options()},
+        )
+
+    model = SentenceTransformer(EMBEDDING_MODEL, device="cuda" if USE_CUDA else None)
+    if _fp16_supported(model.device):
+        # encode() then returns float16 arrays; callers cast to float32 / Python floats as needed
+        model.half()
+    if TORCH_COMPILE:
+        model[0].auto_model = torch.compile(model[0].auto_model, dynamic=True)
+    return model
+
+
+def _onnx_session_options() -> ort.SessionOptions:
+    """Full graph optimization; half the cores so encoding doesn't starve the audio pipeline"""
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = max(1, (os.cpu_count() or 2) // 2)
+    return options
+
+
+@functools.lru_cache(maxsize=1)
+def _cpu_flags() -> frozenset:
+    """Feature flags from /proc/cpuinfo (empty off Linux)"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return frozenset(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return frozenset()
+
+
+def _fp16_supported(device: torch.device) -> bool:
+    """FP16 pays off on GPUs and on CPUs with native FP16 math (AMX-FP16 or AVX512-FP16).
+
+    Plain AVX-512 parts (Skylake, Cascade Lake, Ice Lake) emulate FP16 and run it slower than FP32.
+    """
+    if device.type in ("cuda", "mps"):
+        return True
+    return device.type == "cpu" and not _cpu_flags().isdisjoint({"amx_fp16", "avx512_fp16"})
+
+
+def prefetch_embedder_weights():
+    """Download EMBEDDING_MODEL's PyTorch weights, which the CUDA path and the FP32 fallback load"""
+    SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+
+
+def export_quantized_embedder():
+    """Export the embedder to ONNX with dynamic INT8 (AVX-512 VNNI) quantization"""
+    model = SentenceTransformer(EMBEDDING_MODEL, backend="onnx")
+    model.save(ONNX_MODEL_DIR)
+    export_dynamic_quantized_onnx_model(model, "avx512_vnni", ONNX_MODEL_DIR)
+
+
+def _length_order(texts: List[str]) -> np.ndarray:
+    """Indices that sort texts by length, so each batch pads as little as possible.
+
+    encode() only sorts within the texts it is given; sorting the whole document first keeps the
+    short tail chunk out of a batch of full ones. Callers scatter results back with this order,
+    since chunk_index relies on input order.
+    """
+    return np.argsort([len(t) for t in texts], kind="stable")
+
+
+def topk_cosine(query_vector: np.ndarray, matrix: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact top-k by inner product over L2-normalized rows, best first"""
+    scores = matrix @ query_vector
+    k = min(k, len(scores))
+    idx = np.argpartition(-scores, k - 1)[:k]
+    idx = idx[np.argsort(-scores[idx])]
+    return idx, scores[idx]
+
+
+class LocalIndex:
+    """In-memory index over a single user's document chunks"""
+
+    # Below this many chunks a BLAS matrix-vector scan beats building an HNSW graph
+    EXACT_SEARCH_MAX = 10_000
+
+    def __init__(self, chunk_texts: List[str], embeddings: np.ndarray):
+        self.chunk_texts = chunk_texts
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        faiss.normalize_L2(self.embeddings)
+
+        self.index = None
+        if len(chunk_texts) > self.EXACT_SEARCH_MAX:
+            self.index = faiss.IndexHNSWFlat(self.embeddings.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efSearch = 64
+            self.index.add(self.embeddings)
+
+    def save(self, path: str):
+        """Write texts and embeddings to an .npz, atomically so concurrent jobs never read a partial file"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, texts=np.array(self.chunk_texts, dtype=str), embeddings=self.embeddings)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LocalIndex":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["texts"].tolist(), data["embeddings"])
+
+    def search(self, query_vector: np.ndarray, k: int) -> List[Dict[str, Any]]:
+        if self.index is None:
+            ids, scores = topk_cosine(query_vector, self.embeddings, k)
+        else:
+            scores, ids = self.index.search(query_vector.reshape(1, -1), k)
+            scores, ids = scores[0], ids[0]
+
+        return [
+            {"chunk_text": self.chunk_texts[i], "similarity": float(score)}
+            for score, i in zip(scores, ids)
+            if i != -1
+        ]
 
 
 class RAGService:
-    def __init__(self, supabase_url: str, supabase_key: str, embedder=None):
+    def __init__(self, supabase_url: str, supabase_key: str, embedder: Optional[SentenceTransformer] = None):
         self.supabase: Client = create_client(supabase_url, supabase_key)
-        # self.model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-        self.model = embedder
+        # Never load a private copy of the model; default to the process-wide one
+        self.model = embedder if embedder is not None else get_embedder()
+        # Repeated follow-ups ("sorry, how much?") skip the encoder entirely
+        self._emb_cache = functools.lru_cache(maxsize=1024)(self._encode_one)
+
+    def _encode(self, texts, max_seq_length: int, **kwargs) -> np.ndarray:
+        return _encode_with(self.model, texts, max_seq_length, **kwargs)
+
+    def _encode_documents(self, chunks: List[str]) -> np.ndarray:
+        """Encode ingestion chunks one batch per lock hold so live queries can interleave"""
+        if not chunks:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        order = _length_order(chunks)
+        sorted_embeddings = np.concatenate([
+            self._encode(
+                [chunks[i] for i in order[start : start + DOCUMENT_BATCH_SIZE]],
+                DOCUMENT_MAX_SEQ_LENGTH,
+                batch_size=DOCUMENT_BATCH_SIZE,
+            )
+            for start in range(0, len(chunks), DOCUMENT_BATCH_SIZE)
+        ])
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+        return embeddings
+
+    def _encode_one(self, text: str) -> tuple:
+        """Embed a single query (cached per normalized text)"""
+        return tuple(self._encode(text, QUERY_MAX_SEQ_LENGTH).tolist())
 
     # -------------------------------
     # Document Upload + Chunking
     # -------------------------------
-    def embed_and_store_document(self, user_id: str, filename: str, text: str, chunk_size: int = 500):
+    def embed_and_store_document(
+        self, user_id: str, filename: str, text: str, chunk_size: int = 500, insert_batch_size: int = 500
+    ):
         """Splits text into chunks, embeds, and stores in DB"""
         # Create document entry
         doc = (
@@ -21,33 +262,100 @@ class RAGService:
             .execute()
         ).data[0]
 
-        chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
-        embeddings = self.model.encode(chunks, convert_to_numpy=True).tolist()
+        # Chunk inserts are batched and not atomic: on any failure remove what was written
+        # so a document never exists with a partial set of chunks
+        try:
+            chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+            embeddings = self._encode_documents(chunks)
 
-        # Store chunks
-        rows = []
-        for idx, (chunk, emb) in enumerate(zip(chunks, embeddings)):
-            rows.append(
-                {
-                    "document_id": doc["id"],
-                    "user_id": user_id,
-                    "chunk_index": idx,
-                    "chunk_text": chunk,
-                    "embedding": emb,
-                }
+            # Store chunks, boxing each vector (float32, or float16 from a half-precision model)
+            # into a list only as its batch is sent
+            for start in range(0, len(chunks), insert_batch_size):
+                rows = [
+                    {
+                        "document_id": doc["id"],
+                        "user_id": user_id,
+                        "chunk_index": idx,
+                        "chunk_text": chunks[idx],
+                        "embedding": embeddings[idx].tolist(),
+                    }
+                    for idx in range(start, min(start + insert_batch_size, len(chunks)))
+                ]
+                self.supabase.table("document_chunks").insert(rows).execute()
+        except Exception:
+            self.supabase.table("document_chunks").delete().eq("document_id", doc["id"]).execute()
+            self.supabase.table("documents").delete().eq("id", doc["id"]).execute()
+            raise
+
+        return {"document_id": doc["id"], "chunks": len(chunks)}
+
+    # -------------------------------
+    # Local Index
+    # -------------------------------
+    def build_index(self, user_id: str, page_size: int = 1000) -> Optional[LocalIndex]:
+        """Load all of a user's chunks into a local index (None if they have none)"""
+        texts, vectors = [], []
+        while True:
+            rows = (
+                self.supabase.table("document_chunks")
+                .select("chunk_text, embedding")
+                .eq("user_id", user_id)
+                .order("document_id")
+                .order("chunk_index")
+                .range(len(texts), len(texts) + page_size - 1)
+                .execute()
+            ).data or []
+
+            for row in rows:
+                emb = row["embedding"]
+                texts.append(row["chunk_text"])
+                # pgvector columns come back from PostgREST as "[0.1,0.2,...]"
+                vectors.append(json.loads(emb) if isinstance(emb, str) else emb)
+
+            # The server's max-rows may be below page_size, so only an empty page means done
+            if not rows:
+                break
+
+        if not texts:
+            return None
+
+        embeddings = np.asarray(vectors, dtype=np.float32)
+        model_dim = self.model.get_sentence_embedding_dimension()
+        if embeddings.shape[1] != model_dim:
+            raise ValueError(
+                f"Stored chunks for user {user_id} are {embeddings.shape[1]}-dim but the "
+                f"{EMBEDDING_BACKEND} embedder produces {model_dim}-dim vectors; "
+                "re-embed the user's documents with the current EMBEDDING_BACKEND"
             )
 
-        self.supabase.table("document_chunks").insert(rows).execute()
+        return LocalIndex(texts, embeddings)
+
+    def load_index(self, user_id: str, max_age: float) -> Optional[LocalIndex]:
+        """Return the user's index from the on-disk cache if younger than max_age seconds, else rebuild and cache it"""
+        key = hashlib.sha256(user_id.encode("utf-8")).hexdigest()
+        # The backend is part of the key: switching EMBEDDING_BACKEND changes the vector space
+        path = os.path.join(INDEX_CACHE_DIR, EMBEDDING_BACKEND, f"{key}.npz")
 
-        return {"document_id": doc["id"], "chunks": len(rows)}
+        try:
+            if time.time() - os.path.getmtime(path) < max_age:
+                return LocalIndex.load(path)
+        except (OSError, ValueError):
+            # Missing, or a file we can't read; fall through to a rebuild
+            pass
+
+        index = self.build_index(user_id)
+        if index is not None:
+            index.save(path)
+        return index
 
     # -------------------------------
     # Semantic Search
     # -------------------------------
-    def search(self, query: str, user_id: str, limit: int = 5) -> List[Dict[str, Any]]:
-        """Search relevant chunks for a user"""
-        query_embedding = self.model.encode(query).tolist()
+    def _embed_query(self, query: str) -> Tuple[List[float], np.ndarray]:
+        query_embedding = list(self._emb_cache(query.strip().lower()))
+        return query_embedding, np.asarray(query_embedding, dtype=np.float32)
 
+    def _rpc_search(self, query_embedding: List[float], user_id: str, limit: int) -> List[Dict[str, Any]]:
         response = (
             self.supabase.rpc(
                 "search_document_chunks",
@@ -59,21 +367,42 @@ class RAGService:
             )
             .execute()
         )
-
         return response.data or []
 
+    def search(self, query: str, user_id: str, limit: int = 5, index: Optional[LocalIndex] = None) -> List[Dict[str, Any]]:
+        """Search relevant chunks for a user, locally when an index is given"""
+        query_embedding, query_vector = self._embed_query(query)
+
+        if index is not None:
+            return index.search(query_vector, limit)
+
+        return self._rpc_search(query_embedding, user_id, limit)
+
+    async def asearch(self, query: str, user_id: str, limit: int = 5, index: Optional[LocalIndex] = None) -> List[Dict[str, Any]]:
+        """Async search: encoding and the RPC fallback run in a thread"""
+        query_embedding, query_vector = await asyncio.to_thread(self._embed_query, query)
+
+        if index is not None:
+            return index.search(query_vector, limit)
+
+        return await asyncio.to_thread(self._rpc_search, query_embedding, user_id, limit)
+
     # -------------------------------
     # Context Builder
     # -------------------------------
-    def get_context(self, query: str, user_id: str, max_chunks: int = 5) -> str:
-        """Return combined context string for a query"""
-        chunks = self.search(query, user_id, max_chunks)
-
+    @staticmethod
+    def _build_context(chunks: List[Dict[str, Any]]) -> str:
         if not chunks:
             return ""
 
-        parts = []
-        for c in chunks:
-            parts.append(f"[Chunk]\n{c['chunk_text']} (score={round(c['similarity'],3)})")
+        return "\n\n---\n\n".join(
+            f"[Chunk]\n{c['chunk_text']} (score={c['similarity']:.3f})" for c in chunks
+        )
+
+    def get_context(self, query: str, user_id: str, max_chunks: int = 5, index: Optional[LocalIndex] = None) -> str:
+        """Return combined context string for a query"""
+        return self._build_context(self.search(query, user_id, max_chunks, index))
 
-        return "\n\n---\n\n".join(parts)
+    async def aget_context(self, query: str, user_id: str, max_chunks: int = 5, index: Optional[LocalIndex] = None) -> str:
+        """Async variant of get_context that never blocks the event loop"""
+        return self._build_context(await self.asearch(query, user_id, max_chunks, index))